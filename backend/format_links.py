@@ -1,9 +1,27 @@
-import json
+import sqlite3
+import sys
+from pathlib import Path
 
-with open("links.json", "r", encoding="utf-8") as f:
-    links = json.load(f)
+import orjson
 
-for k, v in links.items():
-    print(f"\nLien ID: {k}")
-    for field, value in v.items():
-        print(f"  {field}: {value}")
+LINKS_DB = Path(__file__).resolve().parent / "data" / "links.db"
+
+# Lecture seule : ne crée pas de base vide si elle n'existe pas encore
+con = sqlite3.connect(f"file:{LINKS_DB}?mode=ro", uri=True)
+con.row_factory = sqlite3.Row
+rows = con.execute(
+    "SELECT sid, payload, created_at, expires_at, claimed, claimed_at, claim FROM links ORDER BY created_at"
+)
+
+# Tout est accumulé puis écrit en un seul appel (au lieu d'un print par ligne)
+out = []
+ap = out.append
+for row in rows:
+    ap(f"\nLien ID: {row['sid']}\n")
+    for field in row.keys()[1:]:
+        value = row[field]
+        if field in ("payload", "claim") and value is not None:
+            value = orjson.loads(value)
+        ap(f"  {field}: {value}\n")
+
+sys.stdout.write("".join(out))
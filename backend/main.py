@@ -1,14 +1,33 @@
 # main.py — LinkiSend backend (API + frontend statique)
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi.responses import RedirectResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
-from typing import Dict, Any
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+from typing import Dict, Any, List, Optional
 from pathlib import Path
-import os, secrets, time, re
+from contextlib import asynccontextmanager, suppress
+from functools import lru_cache
+import os, time, re, asyncio, mimetypes, sqlite3, threading, hashlib, secrets, logging, tempfile
+import orjson
+from cachetools import TTLCache
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = [asyncio.create_task(expiry_sweeper())]
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        # return_exceptions : une tâche morte en erreur n'empêche pas la fermeture
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await HTTP_CLIENT.aclose()
+
+logger = logging.getLogger("linkisend")
 
-app = FastAPI(title="LinkiSend API")
+# orjson pour toutes les réponses JSON (encodeur Rust, sortie bytes directe)
+app = FastAPI(title="LinkiSend API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # CORS permissif pour le front (à restreindre plus tard au domaine)
 app.add_middleware(
@@ -27,38 +46,241 @@ PUBLIC_DIR = BASE_DIR / "public"  # contient index.html, claim.html, assets, man
 
 FRONTEND_BASE = os.getenv("FRONTEND_BASE", "")  # vide = servir localement
 LINK_TTL_SECONDS = int(os.getenv("LINK_TTL_SECONDS", "86400"))  # 24h
+MAX_BULK_LINKS = int(os.getenv("MAX_BULK_LINKS", "500"))  # liens par appel /create-links
 
-RESERVED = {
+RESERVED = frozenset({
     "", "docs", "openapi.json", "favicon.ico", "health",
-    "create-link", "claim", "claim-status", "s", "assets", "static",
+    "create-link", "create-links", "claim", "claim-status", "s", "assets", "static",
     "manifest.json", "service-worker.js", "config.js", "countries.js", "lang"
-}
+})
+
+# ----------------------------
+# Persistance locale (lecture/écriture JSON via orjson)
+# ----------------------------
+DATA_DIR = BASE_DIR / "data"
+
+JSON_CACHE = {}     # { "name": (mtime_ns, expires_at, data) }
+JSON_CACHE_TTL = 30 # secondes
+
+def read_json(name):
+    path = DATA_DIR / f"{name}.json"
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {} if name == "links" else []
+
+    # Cache : même mtime et TTL non écoulé -> pas de relecture ni de parse
+    t = time.monotonic()
+    cached = JSON_CACHE.get(name)
+    if cached and cached[0] == mtime and t < cached[1]:
+        return cached[2]
+
+    data = orjson.loads(path.read_bytes())
+    JSON_CACHE[name] = (mtime, t + JSON_CACHE_TTL, data)
+    return data
+
+def write_atomic(path: Path, data: bytes):
+    # Un seul write() vers un fichier temporaire puis os.replace : jamais de
+    # fichier à moitié écrit, même en cas d'arrêt brutal. Temporaire unique par
+    # appel (même dossier) : écrivains concurrents (threads, workers) séparés
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with open(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+def write_json(name, data):
+    JSON_CACHE.pop(name, None)
+    write_atomic(DATA_DIR / f"{name}.json", orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
 # ----------------------------
-# Stockage POC en mémoire
+# Stockage des liens (SQLite, mode WAL)
 # ----------------------------
-LINKS: Dict[str, Dict[str, Any]] = read_json("links")
+# Une base partagée par tous les workers uvicorn : un lien créé sur un worker
+# est visible et réclamable depuis les autres. WAL = un écrivain, lecteurs
+# concurrents ; synchronous=NORMAL = pas de fsync à chaque commit.
+LINKS_DB = DATA_DIR / "links.db"
+SWEEP_EVERY_SECONDS = int(os.getenv("LINKS_SWEEP_EVERY_SECONDS", "60"))
+SWEEP_BATCH = 1000  # lignes supprimées par transaction (verrou d'écriture court)
+
+# WITHOUT ROWID : les lignes sont rangées directement dans l'arbre de la clé
+# primaire sid. Une recherche par sid = un seul parcours de B-tree (au lieu de
+# l'index automatique sur sid puis de la table par rowid).
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS links (
+        sid        TEXT PRIMARY KEY,
+        payload    BLOB NOT NULL,
+        created_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL,
+        claimed    INTEGER NOT NULL DEFAULT 0,
+        claimed_at INTEGER,
+        claim      BLOB
+    ) WITHOUT ROWID
+    """,
+    # Index partiel : seuls les liens non réclamés (candidats au balayage) y
+    # figurent, trié par échéance. Le balayage lit uniquement la tête échue.
+    "CREATE INDEX IF NOT EXISTS links_unclaimed_expiry ON links (expires_at) WHERE claimed = 0",
+)
+
+_DB_LOCAL = threading.local()
+
+def db() -> sqlite3.Connection:
+    # Une connexion par thread (boucle d'événements + threadpool)
+    con = getattr(_DB_LOCAL, "con", None)
+    if con is None:
+        con = sqlite3.connect(LINKS_DB, isolation_level=None, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA busy_timeout=5000")
+        _DB_LOCAL.con = con
+    return con
+
+def init_links_db():
+    con = db()
+    # Verrou d'écriture : un seul worker initialise, les autres voient la version à jour
+    con.execute("BEGIN IMMEDIATE")
+    for stmt in SCHEMA:
+        con.execute(stmt)
+    if con.execute("PRAGMA user_version").fetchone()[0] == 0:
+        # Première ouverture : reprise de l'ancien stockage links.json
+        con.executemany(
+            "INSERT OR IGNORE INTO links VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    sid, orjson.dumps(item["payload"]), item["created_at"], item["expires_at"],
+                    int(item["claimed"]), item["claimed_at"],
+                    orjson.dumps(item["claim"]) if item["claim"] is not None else None,
+                )
+                for sid, item in read_json("links").items()
+            ],
+        )
+        con.execute("PRAGMA user_version = 1")
+    con.execute("COMMIT")
+
+init_links_db()
+
+def sweep_expired(t: int, limit: int = SWEEP_BATCH) -> int:
+    """Retire jusqu'à `limit` liens expirés non réclamés (les réclamés restent : transfert à traiter)."""
+    return db().execute(
+        "DELETE FROM links WHERE sid IN "
+        "(SELECT sid FROM links WHERE claimed = 0 AND expires_at <= ? LIMIT ?)",
+        (t, limit),
+    ).rowcount
+
+# Écritures synchrones : appelées via asyncio.to_thread, car l'attente du verrou
+# d'écriture (busy_timeout, autre worker en train d'écrire) bloquerait la boucle
+def insert_link(payload: bytes, t: int) -> str:
+    while True:
+        short_id = gen_short_id()
+        try:
+            # Collision quasi impossible ; la clé primaire reste le filet de
+            # sécurité (aucune recherche préalable), y compris entre workers
+            db().execute(
+                "INSERT INTO links (sid, payload, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (short_id, payload, t, t + LINK_TTL_SECONDS),
+            )
+            return short_id
+        except sqlite3.IntegrityError:
+            continue
+
+def insert_links(payloads: List[bytes], t: int) -> List[str]:
+    # Une seule transaction : un verrou d'écriture et un commit pour tout le lot
+    con = db()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        ids = [insert_link(payload, t) for payload in payloads]
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+    return ids
+
+def mark_claimed(sid: str, t: int, claim: bytes) -> bool:
+    # UPDATE conditionnel : une seule réclamation gagne, même entre workers
+    return db().execute(
+        "UPDATE links SET claimed = 1, claimed_at = ?, claim = ? WHERE sid = ? AND claimed = 0",
+        (t, claim, sid),
+    ).rowcount == 1
+
+# sid -> expires_at (immuable) : cache borné, par worker, devant SQLite pour
+# les redirections. Les entrées sortent d'elles-mêmes après LINK_TTL_SECONDS ;
+# un lien supprimé par le balayage était de toute façon déjà expiré.
+LINK_EXPIRY_CACHE = TTLCache(maxsize=int(os.getenv("MAX_CACHED_LINKS", "100000")), ttl=LINK_TTL_SECONDS)
+
+def link_expiry(sid: str) -> Optional[int]:
+    exp = LINK_EXPIRY_CACHE.get(sid)
+    if exp is None:
+        row = db().execute("SELECT expires_at FROM links WHERE sid = ?", (sid,)).fetchone()
+        if row is None:
+            return None  # pas de cache négatif : le lien peut naître sur un autre worker
+        exp = LINK_EXPIRY_CACHE[sid] = row["expires_at"]
+    return exp
+
+async def expiry_sweeper():
+    while True:
+        await asyncio.sleep(SWEEP_EVERY_SECONDS)
+        t = int(time.time())
+        try:
+            # Lots successifs, en rendant la main à la boucle entre deux
+            while await asyncio.to_thread(sweep_expired, t) == SWEEP_BATCH:
+                pass
+        except sqlite3.Error:
+            # Ex. "database is locked" (busy_timeout dépassé) : passe suivante
+            logger.exception("Balayage des liens expirés échoué")
 
 # ----------------------------
 # Modèles
 # ----------------------------
 class CreateLinkIn(BaseModel):
+    # Valeurs stockées déjà canoniques (espaces retirés, téléphone normalisé)
+    model_config = ConfigDict(extra="forbid", frozen=True, str_strip_whitespace=True)
     amount: float = Field(..., gt=0)
     currency: str
     sender_wallet: str
     recipient_phone: str
     network: str
 
+    @field_validator("recipient_phone")
+    @classmethod
+    def _normalize_phone(cls, v: str) -> str:
+        return normalize_phone(v)
+
 class CreateLinkOut(BaseModel):
+    model_config = ConfigDict(frozen=True)
     short_id: str
     expires_in: int
 
+class CreateLinksIn(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+    items: List[CreateLinkIn] = Field(..., min_length=1, max_length=MAX_BULK_LINKS)
+
+class CreateLinksOut(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    links: List[CreateLinkOut]
+
 class ClaimIn(BaseModel):
+    # Normalisation à la validation : str_strip_whitespace est appliqué par
+    # pydantic-core ; les refus métier (400) restent dans le handler
+    model_config = ConfigDict(extra="forbid", frozen=True, str_strip_whitespace=True)
     short_id: str
     phone: str
     wallet: str
 
+    @field_validator("phone")
+    @classmethod
+    def _normalize_phone(cls, v: str) -> str:
+        return normalize_phone(v)
+
 class ClaimOut(BaseModel):
+    model_config = ConfigDict(frozen=True)
     status: str
     short_id: str
     claimed: bool
@@ -67,90 +289,95 @@ class ClaimOut(BaseModel):
 # ----------------------------
 # Helpers
 # ----------------------------
-def gen_short_id(n: int = 6) -> str:
-    alphabet = "23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnpqrstuvwxyz"
-    return "".join(secrets.choice(alphabet) for _ in range(n))
+SHORT_ID_ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnpqrstuvwxyz"
+_SHORT_ID_BASE = len(SHORT_ID_ALPHABET)  # 56
+# 256 % 56 != 0 : les octets >= 224 sont rejetés pour garder un tirage uniforme
+_SHORT_ID_LIMIT = 256 - 256 % _SHORT_ID_BASE
+
+SHORT_ID_LEN = 9
+
+def gen_short_id(n: int = SHORT_ID_LEN) -> str:
+    """
+    Identifiant aléatoire uniforme de n caractères (56^9 ≈ 5,4e15 valeurs).
+    Collision (anniversaires) ≈ k² / (2·56^n) : ~1e-4 pour 1M liens actifs
+    avec n=9, contre ~1 dès 180k liens avec l'ancien n=6.
+    """
+    # Un seul appel à os.urandom (2n octets suffisent presque toujours)
+    chars = ""
+    while len(chars) < n:
+        chars += "".join(SHORT_ID_ALPHABET[b % _SHORT_ID_BASE] for b in os.urandom(2 * n) if b < _SHORT_ID_LIMIT)
+    return chars[:n]
 
 def now() -> int:
     return int(time.time())
 
-def is_expired(item: Dict[str, Any]) -> bool:
-    return now() >= item["expires_at"]
+def is_expired(item, t: int) -> bool:
+    # t : horodatage lu une seule fois par le handler appelant
+    return t >= item["expires_at"]
 
 PHONE_RE = re.compile(r"[^\d+]")
+# Table de suppression ASCII : tout sauf chiffres et "+" (boucle C, sans regex)
+PHONE_TABLE = str.maketrans("", "", "".join(chr(c) for c in range(128) if not (chr(c).isdigit() or chr(c) == "+")))
 
 def normalize_phone(p: str) -> str:
-    p = PHONE_RE.sub("", p or "")
-    return p
-
-# ----------------------------
-# Persistance locale (lecture/écriture JSON)
-# ----------------------------
-import json
-
-DATA_DIR = BASE_DIR / "data"
-
-def read_json(name):
-    path = DATA_DIR / f"{name}.json"
-    if not path.exists():
-        return {} if name == "links" else []
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def write_json(name, data):
-    path = DATA_DIR / f"{name}.json"
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    p = p or ""
+    if p.isascii():
+        return p.translate(PHONE_TABLE)
+    return PHONE_RE.sub("", p)  # chiffres Unicode éventuels : même règle que \d
 
 # ----------------------------
 # API
 # ----------------------------
+def count_links() -> int:
+    return db().execute("SELECT count(*) FROM links").fetchone()[0]
+
 @app.get("/health")
-def health():
-    return {"ok": True, "count": len(LINKS)}
+async def health():
+    # count(*) parcourt toute la table : hors de la boucle d'événements
+    return {"ok": True, "count": await asyncio.to_thread(count_links)}
 
 @app.post("/create-link", response_model=CreateLinkOut)
-def create_link(data: CreateLinkIn):
-    short_id = gen_short_id(6)
-    while short_id in LINKS:
-        short_id = gen_short_id(6)
-
-    payload = data.dict()
-    item = {
-        "payload": payload,
-        "created_at": now(),
-        "expires_at": now() + LINK_TTL_SECONDS,
-        "claimed": False,
-        "claimed_at": None,
-        "claim": None,
-    }
-    LINKS[short_id] = item
-    write_json("links", LINKS)
+async def create_link(data: CreateLinkIn):
+    t = now()
+    # Sérialisation directe par pydantic-core (Rust), sans dict intermédiaire
+    payload = data.model_dump_json().encode()
+    short_id = await asyncio.to_thread(insert_link, payload, t)
+    LINK_EXPIRY_CACHE[short_id] = t + LINK_TTL_SECONDS
     return CreateLinkOut(short_id=short_id, expires_in=LINK_TTL_SECONDS)
 
+@app.post("/create-links", response_model=CreateLinksOut)
+async def create_links(data: CreateLinksIn):
+    t = now()
+    payloads = [item.model_dump_json().encode() for item in data.items]
+    short_ids = await asyncio.to_thread(insert_links, payloads, t)
+    for short_id in short_ids:
+        LINK_EXPIRY_CACHE[short_id] = t + LINK_TTL_SECONDS
+    return CreateLinksOut(
+        links=[CreateLinkOut(short_id=short_id, expires_in=LINK_TTL_SECONDS) for short_id in short_ids]
+    )
+
 @app.post("/claim", response_model=ClaimOut)
-def claim_link(data: ClaimIn):
-    sid = data.short_id.strip()
-    phone = normalize_phone(data.phone)
-    wallet = data.wallet.strip()
+async def claim_link(data: ClaimIn):
+    sid, phone, wallet = data.short_id, data.phone, data.wallet
 
-    item = LINKS.get(sid)
+    item = db().execute("SELECT expires_at, claimed FROM links WHERE sid = ?", (sid,)).fetchone()
     if not item:
         raise HTTPException(status_code=404, detail="Lien introuvable.")
-    if is_expired(item):
+    t = now()
+    if is_expired(item, t):
         raise HTTPException(status_code=410, detail="Lien expiré.")
     if item["claimed"]:
         raise HTTPException(status_code=409, detail="Lien déjà réclamé.")
 
     if not phone or len(phone) < 6:
         raise HTTPException(status_code=400, detail="Numéro de téléphone invalide.")
-    if not wallet.lower().startswith("0x") or len(wallet) < 10:
+    # Préfixe testé caractère par caractère : pas de copie via lower()
+    if len(wallet) < 10 or wallet[0] != "0" or wallet[1] not in "xX":
         raise HTTPException(status_code=400, detail="Adresse wallet invalide.")
 
-    item["claimed"] = True
-    item["claimed_at"] = now()
-    item["claim"] = {"phone": phone, "wallet": wallet}
-    write_json("links", LINKS)
+    claim = orjson.dumps({"phone": phone, "wallet": wallet})
+    if not await asyncio.to_thread(mark_claimed, sid, t, claim):
+        raise HTTPException(status_code=409, detail="Lien déjà réclamé.")
 
     return ClaimOut(
         status="ok",
@@ -160,17 +387,19 @@ def claim_link(data: ClaimIn):
     )
 
 @app.get("/claim-status/{short_id}")
-def claim_status(short_id: str):
-    item = LINKS.get(short_id)
+async def claim_status(short_id: str):
+    item = db().execute(
+        "SELECT created_at, expires_at, claimed, claim FROM links WHERE sid = ?", (short_id,)
+    ).fetchone()
     if not item:
         raise HTTPException(status_code=404, detail="Lien introuvable.")
     return {
         "short_id": short_id,
-        "expired": is_expired(item),
-        "claimed": item["claimed"],
+        "expired": is_expired(item, now()),
+        "claimed": bool(item["claimed"]),
         "created_at": item["created_at"],
         "expires_at": item["expires_at"],
-        "claim": item["claim"],
+        "claim": orjson.loads(item["claim"]) if item["claim"] is not None else None,
     }
 # -----------------------
 # API CoinGecko relay
@@ -180,49 +409,106 @@ import time, httpx
 PRICE_CACHE = {}  # { "symbol": { "ts": timestamp, "usd": float } }
 CACHE_TTL = 30    # secondes
 
+# Mapper symbol -> id CoinGecko
+COINGECKO_IDS = {
+    "ETH": "ethereum",
+    "BNB": "binancecoin",
+    "MATIC": "matic-network",
+    "AVAX": "avalanche-2",
+    "SOL": "solana",
+    "USDT": "tether",
+    "USDC": "usd-coin",
+    "DAI": "dai",
+    "WBTC": "wrapped-bitcoin",
+    "LINK": "chainlink",
+    "BONK": "bonk",
+    "RAY": "raydium",
+}
+# URLs CoinGecko construites une fois au chargement (relatives à HTTP_CLIENT.base_url)
+COINGECKO_API = "/api/v3/simple/price"
+COINGECKO_BATCH_URL = f"{COINGECKO_API}?ids={','.join(COINGECKO_IDS.values())}&vs_currencies=usd"
+
+# Client partagé : connexions TCP/TLS (HTTP/2) réutilisées d'un appel à l'autre
+# Taille du pool bornée : contre-pression quand CoinGecko limite le débit
+HTTP_CLIENT = httpx.AsyncClient(
+    base_url="https://api.coingecko.com",
+    timeout=10,
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("HTTPX_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("HTTPX_MAX_KEEPALIVE", "50")),
+    ),
+)
+PRICE_INFLIGHT: Optional[asyncio.Task] = None  # appel groupé CoinGecko en cours
+PRICE_ERROR_TTL = 5                            # échec récent mémorisé (évite de marteler sur 429)
+PRICE_ERRORS = {}  # { "symbol": { "ts": timestamp, "detail": str } }
+PRICE_RETRY_AT = 0.0  # pas de rafraîchissement de fond avant (dernier appel groupé en échec)
+
+async def fetch_prices():
+    """Récupère tous les symboles en un seul appel CoinGecko (ids=a,b,c...)."""
+    r = await HTTP_CLIENT.get(COINGECKO_BATCH_URL)
+    r.raise_for_status()
+    data = r.json()
+    ts = time.time()
+    for sym, cg_id in COINGECKO_IDS.items():
+        if cg_id in data:
+            PRICE_CACHE[sym] = {"ts": ts, "usd": data[cg_id]["usd"]}
+
+def _prices_fetched(task: asyncio.Task):
+    global PRICE_INFLIGHT, PRICE_RETRY_AT
+    PRICE_INFLIGHT = None
+    # exception() la marque aussi comme lue, même sans attente
+    if task.cancelled() or task.exception() is not None:
+        PRICE_RETRY_AT = time.time() + PRICE_ERROR_TTL
+
+def prices_task() -> asyncio.Task:
+    # Single-flight : rafraîchissement et caches froids (tous symboles
+    # confondus) partagent le même appel groupé
+    global PRICE_INFLIGHT
+    if PRICE_INFLIGHT is None:
+        PRICE_INFLIGHT = asyncio.create_task(fetch_prices())
+        PRICE_INFLIGHT.add_done_callback(_prices_fetched)
+    return PRICE_INFLIGHT
+
 @app.get("/price")
-def get_price(symbol: str):
+async def get_price(symbol: str):
     """
     Retourne le prix USD d'un token via CoinGecko, avec cache 30s.
+    Un prix trop ancien est renvoyé avec "cached": "stale" et déclenche un
+    rafraîchissement en tâche de fond : CoinGecko n'est appelé qu'en
+    présence de trafic, au plus une fois par CACHE_TTL.
     Exemple : /price?symbol=ETH
     """
     sym = symbol.upper()
 
     # 1. Vérifier le cache
     now = time.time()
-    if sym in PRICE_CACHE and now - PRICE_CACHE[sym]["ts"] < CACHE_TTL:
-        return {"symbol": sym, "usd": PRICE_CACHE[sym]["usd"], "cached": True}
-
-    # 2. Mapper symbol -> id CoinGecko
-    COINGECKO_IDS = {
-        "ETH": "ethereum",
-        "BNB": "binancecoin",
-        "MATIC": "matic-network",
-        "AVAX": "avalanche-2",
-        "SOL": "solana",
-        "USDT": "tether",
-        "USDC": "usd-coin",
-        "DAI": "dai",
-        "WBTC": "wrapped-bitcoin",
-        "LINK": "chainlink",
-        "BONK": "bonk",
-        "RAY": "raydium",
-    }
+    entry = PRICE_CACHE.get(sym)
+    if entry:
+        if now - entry["ts"] < CACHE_TTL:
+            return {"symbol": sym, "usd": entry["usd"], "cached": True}
+        # Périmé : appel groupé partagé lancé sans l'attendre (sauf échec récent)
+        if now >= PRICE_RETRY_AT:
+            prices_task()
+        return {"symbol": sym, "usd": entry["usd"], "cached": "stale"}
+
     if sym not in COINGECKO_IDS:
         raise HTTPException(status_code=400, detail="Token non supporté")
 
-    # 3. Appeler CoinGecko côté serveur
-    url = f"https://api.coingecko.com/api/v3/simple/price?ids={COINGECKO_IDS[sym]}&vs_currencies=usd"
+    # 2. Cache froid (premier appel pour ce symbole) : appel groupé partagé,
+    #    sauf si CoinGecko vient d'échouer pour ce symbole
+    err = PRICE_ERRORS.get(sym)
+    if err and now - err["ts"] < PRICE_ERROR_TTL:
+        raise HTTPException(status_code=502, detail=err["detail"])
+
     try:
-        r = httpx.get(url, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        price = data[COINGECKO_IDS[sym]]["usd"]
+        # shield : un client qui abandonne n'annule pas l'appel des autres
+        await asyncio.shield(prices_task())
+        price = PRICE_CACHE[sym]["usd"]
     except Exception as e:
-        raise HTTPException(status_code=502, detail=f"Erreur CoinGecko: {str(e)}")
-
-    # 4. Mettre à jour le cache
-    PRICE_CACHE[sym] = {"ts": now, "usd": price}
+        detail = f"Erreur CoinGecko: {str(e)}"
+        PRICE_ERRORS[sym] = {"ts": now, "detail": detail}
+        raise HTTPException(status_code=502, detail=detail)
 
     return {"symbol": sym, "usd": price, "cached": False}
 
@@ -231,135 +517,235 @@ def get_price(symbol: str):
 # ----------------------------
 from fastapi import Header
 
-API_KEY = os.getenv("INTERNAL_API_KEY", "dev-key-linkisend")
+# Seule l'empreinte SHA-256 de la clé est gardée en mémoire ; elle peut être
+# fournie directement au déploiement via INTERNAL_API_KEY_SHA256 (hex).
+API_KEY_HASH = (
+    bytes.fromhex(os.getenv("INTERNAL_API_KEY_SHA256", ""))
+    or hashlib.sha256(os.getenv("INTERNAL_API_KEY", "dev-key-linkisend").encode()).digest()
+)
 
 def check_key(x_api_key: str = Header(None)):
-    if x_api_key != API_KEY:
+    # Comparaison à temps constant de deux empreintes de taille fixe
+    given = hashlib.sha256((x_api_key or "").encode()).digest()
+    if not secrets.compare_digest(given, API_KEY_HASH):
         raise HTTPException(status_code=403, detail="Unauthorized")
 
+# Lectures/écritures disque déportées dans un thread (asyncio.to_thread)
 @app.get("/api/users")
-def get_users(x_api_key: str = Header(None)):
+async def get_users(x_api_key: str = Header(None)):
     check_key(x_api_key)
-    return read_json("users")
+    return await asyncio.to_thread(read_json, "users")
 
 @app.post("/api/users")
-def add_user(user: Dict[str, Any], x_api_key: str = Header(None)):
+async def add_user(user: Dict[str, Any], x_api_key: str = Header(None)):
     check_key(x_api_key)
-    data = read_json("users")
+    data = list(await asyncio.to_thread(read_json, "users"))  # copie : ne pas muter le cache
     data.append(user)
-    write_json("users", data)
+    await asyncio.to_thread(write_json, "users", data)
     return {"status": "ok", "count": len(data)}
 
 @app.get("/api/referrals")
-def get_referrals(x_api_key: str = Header(None)):
+async def get_referrals(x_api_key: str = Header(None)):
     check_key(x_api_key)
-    return read_json("referrals")
+    return await asyncio.to_thread(read_json, "referrals")
 
 @app.get("/api/airdrops")
-def get_airdrops(x_api_key: str = Header(None)):
+async def get_airdrops(x_api_key: str = Header(None)):
     check_key(x_api_key)
-    return read_json("airdrops")
+    return await asyncio.to_thread(read_json, "airdrops")
 # ----------------------------
 # Frontend statique
 # ----------------------------
+INDEX_FILE = PUBLIC_DIR / "index.html"
+CLAIM_FILE = PUBLIC_DIR / "claim.html"
+MANIFEST_FILE = PUBLIC_DIR / "manifest.json"
+SW_FILE = PUBLIC_DIR / "service-worker.js"
+
+CACHE_CONTROL_DEFAULT = "public, max-age=3600"
+CACHE_CONTROL = {SW_FILE: "no-cache"}  # le service worker doit toujours être revalidé
+
+# Variantes précompressées (générées par precompress.py), préférées dans cet ordre
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# Pages servies depuis la mémoire : lues une fois, aucun stat()/read() par requête
+PAGES = {}  # { Path: {"media_type": str, "cache_control": str, "bodies": [(encoding, bytes, etag)]} }
+
+def load_page(path: Path) -> dict:
+    raw = path.read_bytes()
+    bodies = []
+    for encoding, suffix in ENCODINGS:
+        # Une variante plus ancienne que l'original est ignorée (périmée)
+        variant = path.with_name(path.name + suffix)
+        if variant.exists() and variant.stat().st_mtime >= path.stat().st_mtime:
+            bodies.append((encoding, variant.read_bytes()))
+    bodies.append((None, raw))
+    return {
+        "media_type": mimetypes.guess_type(path.name)[0],
+        "cache_control": CACHE_CONTROL.get(path, CACHE_CONTROL_DEFAULT),
+        # ETag propre à chaque représentation (compressée ou non)
+        "bodies": [(enc, body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"') for enc, body in bodies],
+    }
+
+@lru_cache(maxsize=256)
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    # "gzip, br;q=0" -> {"gzip": 1.0, "br": 0.0} ; peu de valeurs distinctes, d'où le cache
+    prefs = {}
+    for token in accept_encoding.split(","):
+        name, *params = token.split(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        prefs[name] = q
+    return prefs
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    # Comparaison faible (RFC 9110) : "*" ou l'un des tags listés, préfixe W/ ignoré
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def static_file(path: Path, accept_encoding: str = "", if_none_match: str = "") -> Response:
+    page = PAGES.get(path)
+    if page is None:
+        page = PAGES[path] = load_page(path)
+    prefs = accepted_encodings(accept_encoding)
+    for encoding, body, etag in page["bodies"]:
+        # q=0 = refus explicite ; "*" couvre les encodages non cités
+        if encoding is None or prefs.get(encoding, prefs.get("*", 0.0)) > 0:
+            headers = {"ETag": etag, "Cache-Control": page["cache_control"], "Vary": "Accept-Encoding"}
+            if if_none_match and etag_matches(etag, if_none_match):
+                return Response(status_code=304, headers=headers)
+            if encoding:
+                headers["Content-Encoding"] = encoding
+            return Response(body, media_type=page["media_type"], headers=headers)
+
+def serve_page(path: Path, request: Request) -> Response:
+    headers = request.headers
+    return static_file(path, headers.get("accept-encoding", ""), headers.get("if-none-match", ""))
+
 if not FRONTEND_BASE:
+    # Vérification unique au démarrage plutôt qu'un exists() par requête
+    missing = [p.name for p in (INDEX_FILE, CLAIM_FILE, MANIFEST_FILE, SW_FILE) if not p.exists()]
+    if missing:
+        raise RuntimeError(f"Fichiers frontend manquants : {', '.join(missing)}")
+    for p in (INDEX_FILE, CLAIM_FILE, MANIFEST_FILE, SW_FILE):
+        PAGES[p] = load_page(p)
+
     # Montages statiques
     app.mount("/assets", StaticFiles(directory=PUBLIC_DIR / "assets"), name="assets")
     app.mount("/static", StaticFiles(directory=PUBLIC_DIR), name="public")
 
     # Routes explicites
     @app.get("/", include_in_schema=False)
-    def serve_index():
-        index_file = PUBLIC_DIR / "index.html"
-        if not index_file.exists():
-            raise HTTPException(status_code=500, detail="index.html manquant.")
-        return FileResponse(index_file)
+    async def serve_index(request: Request):
+        return serve_page(INDEX_FILE, request)
 
     @app.get("/claim", include_in_schema=False)
-    def serve_claim():
-        claim_file = PUBLIC_DIR / "claim.html"
-        if not claim_file.exists():
-            raise HTTPException(status_code=500, detail="claim.html manquant.")
-        return FileResponse(claim_file)
+    async def serve_claim(request: Request):
+        return serve_page(CLAIM_FILE, request)
 
     @app.get("/manifest.json", include_in_schema=False)
-    def serve_manifest():
-        mf = PUBLIC_DIR / "manifest.json"
-        if not mf.exists():
-            raise HTTPException(status_code=500, detail="manifest.json manquant.")
-        return FileResponse(mf)
+    async def serve_manifest(request: Request):
+        return serve_page(MANIFEST_FILE, request)
 
     @app.get("/service-worker.js", include_in_schema=False)
-    def serve_sw():
-        sw = PUBLIC_DIR / "service-worker.js"
-        if not sw.exists():
-            raise HTTPException(status_code=500, detail="service-worker.js manquant.")
-        return FileResponse(sw)
+    async def serve_sw(request: Request):
+        return serve_page(SW_FILE, request)
 
 # ----------------------------
 # Routage par domaine (landing / app / admin)
 # ----------------------------
-from fastapi import Request
-
-@app.middleware("http")
-async def unified_router(request: Request, call_next):
-    host = request.headers.get("host", "")
-    path = request.url.path
-        # Laisse passer directement les routes API
-    if path.startswith("/api/"):
-        return await call_next(request)
-
-    # Domaine principal -> page d’attente
-    if host.startswith("linkisend.io"):
-        if path in ["/", ""]:
-            landing_file = PUBLIC_DIR / "landing.html"
-            if landing_file.exists():
-                return FileResponse(landing_file)
-
-    # Sous-domaine admin -> panneau d’administration
-    elif host.startswith("admin.linkisend.io"):
-        admin_file = PUBLIC_DIR / "admin" / "index.html"
-        if admin_file.exists():
-            return FileResponse(admin_file)
-
-    # Sinon, comportement normal (PWA ou API)
-    response = await call_next(request)
-    return response
-# ----------------------------
-# Route dédiée à l’administration
-# ----------------------------
-from fastapi import Request
-
-@app.middleware("http")
-async def admin_router(request: Request, call_next):
-    host = request.headers.get("host", "")
-    # Si le domaine est admin.linkisend.io -> servir le panneau admin
-    if host.startswith("admin.linkisend.io"):
-        admin_file = PUBLIC_DIR / "admin" / "index.html"
-        if admin_file.exists():
-            return FileResponse(admin_file)
-    return await call_next(request)
+
+LANDING_FILE = PUBLIC_DIR / "landing.html"
+ADMIN_FILE = PUBLIC_DIR / "admin" / "index.html"
+
+# host -> (fichier, chemins servis ; None = tous). Existence vérifiée une seule fois.
+HOST_ROUTES = {
+    host: (file, paths)
+    for host, file, paths in (
+        ("linkisend.io", LANDING_FILE, frozenset({"/", ""})),       # page d’attente
+        ("admin.linkisend.io", ADMIN_FILE, None),                   # panneau d’administration
+    )
+    if file.exists()
+}
+for file, _ in HOST_ROUTES.values():
+    PAGES[file] = load_page(file)
+
+class HostRouter:
+    """Middleware ASGI pur (pas de BaseHTTPMiddleware ni de copie requête/réponse)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Les routes API passent directement ; sinon comportement normal (PWA ou API)
+        if scope["type"] == "http" and not scope["path"].startswith("/api/"):
+            host = accept_encoding = if_none_match = b""
+            for name, value in scope["headers"]:
+                if name == b"host":
+                    host = value
+                elif name == b"accept-encoding":
+                    accept_encoding = value
+                elif name == b"if-none-match":
+                    if_none_match = value
+            route = HOST_ROUTES.get(host.decode("latin-1").split(":", 1)[0])
+            if route and (route[1] is None or scope["path"] in route[1]):
+                response = static_file(route[0], accept_encoding.decode("latin-1"), if_none_match.decode("latin-1"))
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(HostRouter)
 # ----------------------------
 # Redirections courtes
 # ----------------------------
-@app.get("/s/{short_id}")
-def redirect_legacy(short_id: str):
-    item = LINKS.get(short_id)
-    if not item or is_expired(item):
+# Préfixe de redirection calculé une fois au chargement
+REDIRECT_PREFIX = f"{FRONTEND_BASE.rstrip('/')}/claim.html?sid=" if FRONTEND_BASE else "/claim?sid="
+
+# Route Starlette brute : pas de résolution de dépendances ni de validation
+# Pydantic du paramètre de chemin sur le chemin le plus chaud
+async def redirect_legacy(request: Request):
+    short_id = request.path_params["short_id"]
+    exp = link_expiry(short_id)
+    if exp is None or exp <= int(time.time()):
         raise HTTPException(status_code=404, detail="Lien invalide ou expiré.")
-    if FRONTEND_BASE:
-        target = f"{FRONTEND_BASE.rstrip('/')}/claim.html?sid={short_id}"
-        return RedirectResponse(url=target, status_code=307)
-    return RedirectResponse(url=f"/claim?sid={short_id}", status_code=307)
+    return RedirectResponse(url=REDIRECT_PREFIX + short_id, status_code=307)
+
+app.add_route("/s/{short_id}", redirect_legacy, methods=["GET"], include_in_schema=False)
 
 @app.get("/{short_id}")
-def redirect_root(short_id: str):
-    if short_id in RESERVED:
-        raise HTTPException(status_code=404, detail="Not found.")
-    item = LINKS.get(short_id)
-    if not item or is_expired(item):
+async def redirect_root(short_id: str):
+    # Les noms réservés ne sont jamais des short_id : le cas courant ne paie
+    # que la recherche de l'échéance (cache puis clé primaire)
+    exp = link_expiry(short_id)
+    if exp is None:
+        if short_id in RESERVED:
+            raise HTTPException(status_code=404, detail="Not found.")
         raise HTTPException(status_code=404, detail="Lien invalide ou expiré.")
-    if FRONTEND_BASE:
-        target = f"{FRONTEND_BASE.rstrip('/')}/claim.html?sid={short_id}"
-        return RedirectResponse(url=target, status_code=307)
-    return RedirectResponse(url=f"/claim?sid={short_id}", status_code=307)
+    if exp <= int(time.time()):
+        raise HTTPException(status_code=404, detail="Lien invalide ou expiré.")
+    return RedirectResponse(url=REDIRECT_PREFIX + short_id, status_code=307)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop + httptools (fournis par uvicorn[standard]) ; pas de log d'accès
+    # par requête en production. Les liens étant dans SQLite, plusieurs
+    # workers partagent le même état.
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        access_log=os.getenv("ACCESS_LOG", "0") == "1",
+        workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))),
+    )
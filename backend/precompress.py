@@ -0,0 +1,22 @@
+# precompress.py — génère les variantes .gz / .br des pages servies par main.py
+# À lancer au build (après toute modification de public/) : python precompress.py
+import gzip
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # brotli optionnel : seules les variantes .gz sont produites
+    brotli = None
+
+PUBLIC_DIR = Path(__file__).resolve().parent / "public"
+FILES = ["index.html", "claim.html", "manifest.json", "service-worker.js", "landing.html", "admin/index.html"]
+
+for name in FILES:
+    path = PUBLIC_DIR / name
+    if not path.exists():
+        continue
+    raw = path.read_bytes()
+    path.with_name(path.name + ".gz").write_bytes(gzip.compress(raw, compresslevel=9, mtime=0))
+    if brotli is not None:
+        path.with_name(path.name + ".br").write_bytes(brotli.compress(raw, quality=11))
+    print(f"{name}: {len(raw)} octets compressés")